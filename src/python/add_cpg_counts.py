@@ -5,40 +5,41 @@ import os.path as op
 import subprocess
 import shlex
 import datetime
+import json
 from multiprocessing import Pool
 import argparse
-from init_genome import chromosome_order
 from utils_wgbs import IllegalArgumentError, match_maker_tool, eprint, \
-        add_cpg_count_tool, validate_local_exe
+        add_cpg_count_tool, validate_local_exe, EmptyBamError
 from bam2pat import add_args, subprocess_wrap, validate_bam, is_pair_end, MAPQ, extend_region
 from genomic_region import GenomicRegion
 
+try:
+    import pysam    # optional. If installed, read bam headers and first reads in-process
+except ModuleNotFoundError:
+    pysam = None
+
 
 BAM_SUFF = '.bam'
+META_SUFF = '.wgbs_meta.json'
+# consecutive chromosomes shorter than this (e.g. unplaced contigs) are processed together by a single job
+MIN_JOB_BP = 20 * 10 ** 6
 
 # Minimal Mapping Quality to consider.
 # 10 means include only reads w.p. >= 0.9 to be mapped correctly.
 # And missing values (255)
 
 
-def proc_chr(input_path, out_path_name, region, genome, header_path, paired_end, ex_flags, mapq, debug, min_cpg, clip,
-             bed_file, add_pat, in_flags):
-    """ Convert a temp single chromosome file, extracted from a bam file,
-        into a sam formatted (no header) output file."""
-
-    # Run patter tool 'bam' mode on a single chromosome
-
-    unsorted_bam = out_path_name + '_unsorted.output.bam'
-    out_path = out_path_name + '.output.bam'
-    out_directory = os.path.dirname(out_path)
-
+def region_cmd(input_path, region, genome, paired_end, ex_flags, mapq, debug, min_cpg, clip,
+               bed_file, add_pat, in_flags, sam_threads):
+    """ The command that adds CpG counts to the reads of a single region (e.g. a chromosome).
+        Prints sam formatted (no header) lines """
     # use samtools to extract only the reads from 'chrom'
     # flag = '-f 3' if paired_end else ''
     if in_flags is None:
         in_flags = '-f 3' if paired_end else ''
     else:
         in_flags = f'-f {in_flags}'
-    cmd = "samtools view {} {} -q {} -F {} {}".format(input_path, region, mapq, ex_flags, in_flags)
+    cmd = "samtools view -@ {} {} {} -q {} -F {} {}".format(sam_threads, input_path, region, mapq, ex_flags, in_flags)
     if bed_file is not None:
         cmd += f"-M -L {bed_file} | "
     else:
@@ -53,22 +54,68 @@ def proc_chr(input_path, out_path_name, region, genome, header_path, paired_end,
         cmd += f' --min_cpg {str(min_cpg)}'
     if add_pat:
         cmd += ' --pat'
-    cmd += f' | cat {header_path} - | samtools view -b - > {unsorted_bam}'
+    return cmd
 
-    sort_cmd = f'samtools sort -o {out_path} -T {out_directory} {unsorted_bam}'  # TODO: use temp directory, as in bam2pat
+
+def proc_chr(input_path, out_path_name, regions, genome, header_path, paired_end, ex_flags, mapq, debug, min_cpg, clip,
+             bed_file, add_pat, in_flags, sam_threads=0, out_path=None, write_index=False):
+    """ Convert a temp single chromosome file, extracted from a bam file,
+        into a sam formatted (no header) output file.
+        regions is a list of regions (e.g. several small contigs), all written to the same output file.
+        If write_index, samtools writes a bai index of out_path as well"""
+
+    # Run patter tool 'bam' mode on each region, and sort them together
+
+    if out_path is None:
+        out_path = out_path_name + '.output.bam'
+    out_directory = os.path.dirname(out_path)
+
+    cmds = [region_cmd(input_path, r, genome, paired_end, ex_flags, mapq, debug, min_cpg, clip,
+                       bed_file, add_pat, in_flags, sam_threads) for r in regions]
+    # print the header first, then the reads. Unlike "| cat {header_path} -", the reads are not piped through cat
+    cmd = '{ ' + f'cat {header_path}; ' + '; '.join(cmds) + '; }'
+
+    out_opts = f'--write-index -o {out_path}##idx##{out_path}.bai' if write_index else f'-o {out_path}'
+    if paired_end:
+        # match_maker moved each read next to its mate, so the reads are no longer sorted.
+        # pipe the uncompressed bam directly to sort, so the output is compressed only once
+        cmd += f' | samtools view -@ {sam_threads} -u - '
+        cmd += f' | samtools sort -@ {sam_threads} -l 6 {out_opts} -T {out_directory} -'  # TODO: use temp directory, as in bam2pat
+    else:
+        # single-end reads keep the (sorted) order of samtools view - no need to sort them
+        cmd += f' | samtools view -@ {sam_threads} -O bam,level=6 {out_opts} - '
 
     # print(cmd)
     subprocess_wrap(cmd, debug)
-    subprocess_wrap(sort_cmd, debug)
-    os.remove(unsorted_bam)
     return out_path
 
+def group_chroms(chroms, lengths, min_bp=MIN_JOB_BP):
+    """ group consecutive chromosomes to jobs of at least min_bp base pairs.
+        Keeps the chromosomes order, so the jobs outputs can be concatenated as is """
+    jobs = []
+    cur_job, cur_bp = [], 0
+    for c, l in zip(chroms, lengths):
+        cur_job.append(c)
+        cur_bp += l
+        if cur_bp >= min_bp:
+            jobs.append(cur_job)
+            cur_job, cur_bp = [], 0
+    if cur_job:
+        jobs.append(cur_job)
+    return jobs
+
+
 def get_header_command(input_path):
     return f'samtools view -H {input_path}'
 
 def proc_header(input_path, out_path, debug):
     """ extracts header from bam file and saves it to tmp file."""
 
+    if pysam is not None and not debug:
+        with pysam.AlignmentFile(input_path, 'rb') as f, open(out_path, 'w') as out:
+            out.write(str(f.header))
+        return out_path
+
     cmd = get_header_command(input_path) + f' > {out_path} '
     #print(cmd)
     subprocess_wrap(cmd, debug)
@@ -76,6 +123,74 @@ def proc_header(input_path, out_path, debug):
     return out_path
 
 
+def is_cache_valid(cache_path, bam_path):
+    """ a sidecar cache is valid if it is newer than both the bam and its index """
+    if not op.isfile(cache_path):
+        return False
+    cache_time = op.getmtime(cache_path)
+    for f in (bam_path, bam_path + '.bai'):
+        if op.isfile(f) and op.getmtime(f) >= cache_time:
+            return False
+    return True
+
+
+def get_bam_chroms(bam_path):
+    """ list the chromosomes (@SQ lines) in the bam header, and their lengths """
+    if pysam is not None:
+        with pysam.AlignmentFile(bam_path, 'rb') as f:
+            return list(f.references), list(f.lengths)
+
+    # parse only the header block (unlike idxstats, which reads the whole index)
+    # print "SN LN" per @SQ line, whatever order the tags are in
+    cmd = f'samtools view -H {bam_path} | awk -F"\\t" -v OFS="\\t" \'$1=="@SQ"{{sn=""; ln=""; ' \
+          'for(i=2;i<=NF;i++){if($i~/^SN:/) sn=substr($i,4); else if($i~/^LN:/) ln=substr($i,4)} print sn, ln}\''
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = p.communicate()
+    if p.returncode or not output:
+        eprint("[wt acc] Failed with samtools view -H %d\n%s\n%s" % (p.returncode, output.decode(), error.decode()))
+        eprint(cmd)
+        eprint('[wt acc] falied to find chromosomes')
+        return [], []
+    rows = [l.split('\t') for l in output.decode().splitlines()]
+    return [r[0] for r in rows], [int(r[1]) for r in rows]
+
+
+def bam_is_pair_end(bam_path):
+    """ is the first read of the bam paired """
+    if pysam is None:
+        return bool(is_pair_end(bam_path))
+    with pysam.AlignmentFile(bam_path, 'rb') as f:
+        for read in f.fetch(until_eof=True):
+            return read.is_paired
+    raise EmptyBamError('Empty bam file')
+
+
+def get_bam_meta(bam_path):
+    """ chromosomes and paired-end status of a bam file.
+        Cache them in a json sidecar file next to the bam """
+    cache_path = bam_path + META_SUFF
+    if is_cache_valid(cache_path, bam_path):
+        with open(cache_path, 'r') as f:
+            meta = json.load(f)
+        if 'lengths' in meta:   # else, an outdated cache
+            return meta
+
+    chroms, lengths = get_bam_chroms(bam_path)
+    meta = {'chroms': chroms,
+            'lengths': lengths,
+            'paired_end': bam_is_pair_end(bam_path)}
+    if not meta['chroms']:
+        return meta
+
+    # cache is optional - ignore failures (e.g. no write permissions)
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(meta, f)
+    except OSError:
+        pass
+    return meta
+
+
 class BamMethylData:
     def __init__(self, args, bam_path):
         self.args = args
@@ -83,8 +198,11 @@ class BamMethylData:
         self.bam_path = bam_path
         self.debug = args.debug
         self.add_pat = args.add_pat
+        self.sam_threads = args.samtools_threads
         self.gr = GenomicRegion(args)
         self.validate_input()
+        self.meta = get_bam_meta(self.bam_path)
+        self.PE = self.meta['paired_end']
 
     def validate_input(self):
 
@@ -124,20 +242,15 @@ class BamMethylData:
             return [self.gr.region_str]
 
         # get all chromosomes present in the bam file header
-        cmd = f'samtools idxstats {self.bam_path} | cut -f1 '
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, error = p.communicate()
-        if p.returncode or not output:
-            eprint("[wt acc] Failed with samtools idxstats %d\n%s\n%s" % (p.returncode, output.decode(), error.decode()))
-            eprint(cmd)
-            eprint('[wt acc] falied to find chromosomes')
+        bam_chroms = self.meta['chroms']
+        if not bam_chroms:
             return []
-        bam_chroms = output.decode()[:-1].split('\n')
 
         # get all chromosomes from the reference genome:
-        ref_chroms = self.gr.genome.get_chroms()
+        ref_chroms = set(self.gr.genome.get_chroms())
         # intersect the chromosomes from the bam and from the reference
-        intersected_chroms = list(set(bam_chroms) & set(ref_chroms))
+        # keep the bam header order, so the per-chromosome outputs can be concatenated as is
+        intersected_chroms = [c for c in bam_chroms if c in ref_chroms]
 
         if not intersected_chroms:
             msg = '[wt acc] Failed retrieving valid chromosome names. '
@@ -147,7 +260,7 @@ class BamMethylData:
             eprint(msg)
             raise IllegalArgumentError('Failed')
 
-        return list(sorted(intersected_chroms, key=chromosome_order))  # todo use the same order as in ref_chroms instead of resorting it
+        return intersected_chroms
 
     def intermediate_bam_file_view(self, name):
         return '<(samtools view {})'.format(name)
@@ -165,13 +278,17 @@ class BamMethylData:
         if self.gr.region_str is None:
             final_path = name + f".{self.args.suffix}" + BAM_SUFF
             processes = []
-            with Pool(self.args.threads) as p:
-                for c in self.set_regions():
-                    out_path_name = name + '_' + c
-                    params = (self.bam_path, out_path_name, c, self.gr.genome,
-                            header_path, is_pair_end(self.bam_path), self.args.exclude_flags,
+            # each samtools call in a job uses sam_threads additional threads - avoid oversubscription
+            nr_jobs = max(1, self.args.threads // (self.sam_threads + 1))
+            chroms = self.set_regions()
+            lengths = dict(zip(self.meta['chroms'], self.meta['lengths']))
+            with Pool(nr_jobs) as p:
+                for job in group_chroms(chroms, [lengths[c] for c in chroms]):
+                    out_path_name = name + '_' + job[0]
+                    params = (self.bam_path, out_path_name, job, self.gr.genome,
+                            header_path, self.PE, self.args.exclude_flags,
                             self.args.mapq, self.debug, self.args.min_cpg, self.args.clip, self.args.regions_file,
-                              self.add_pat, self.args.include_flags)
+                              self.add_pat, self.args.include_flags, self.sam_threads)
                     processes.append(p.apply_async(proc_chr, params))
                 if not processes:
                     raise IllegalArgumentError('Empty bam file')
@@ -182,14 +299,19 @@ class BamMethylData:
             region_str_for_name = self.gr.region_str.replace(":", "_").replace("-", "_")
             final_path = name + f".{region_str_for_name}" + f".{self.args.suffix}" + BAM_SUFF
             out_path_name = name + '_' + "1"
-            res = [proc_chr(self.bam_path, out_path_name, self.gr.region_str, self.gr.genome, header_path,
-                            is_pair_end(self.bam_path), self.args.exclude_flags, self.args.mapq, self.debug,
+            # a single part - sort it directly to the final path, and index it on the fly
+            res = [proc_chr(self.bam_path, out_path_name, [self.gr.region_str], self.gr.genome, header_path,
+                            self.PE, self.args.exclude_flags, self.args.mapq, self.debug,
                             self.args.min_cpg, self.args.clip, self.args.regions_file,
-                              self.add_pat, self.args.include_flags)]
+                              self.add_pat, self.args.include_flags, self.sam_threads,
+                            final_path, True)]
         print('finished adding CpG counts')
         if None in res:
             print('threads failed')
             return
+        if self.gr.region_str is not None:
+            os.remove(header_path)
+            return
 
         print(datetime.datetime.now().isoformat() + ": finished processing each chromosome")
         # Concatenate chromosome files
@@ -197,7 +319,8 @@ class BamMethylData:
         out_directory = os.path.dirname(final_path)
         # cmd = '/bin/bash -c "cat <({})'.format(get_header_command(self.bam_path)) + ' ' +\
         #       ' '.join([self.intermediate_bam_file_view(p) for p in res]) + ' | samtools view -b - > ' + final_path_unsorted + '"'
-        cmd = f"samtools merge -c -p -f -h {header_path} {final_path} " + ' '.join([p for p in res])
+        # the parts are disjoint, sorted, and ordered as in the header - no need to merge them
+        cmd = f"samtools cat -@ {self.sam_threads} -h {header_path} -o {final_path} " + ' '.join([p for p in res])
         # cmd = '/bin/bash -c "samtools cat -h <({})'.format(get_header_command(self.bam_path)) + ' ' + \
         #       ' '.join(
         #           [p for p in res]) + ' > ' + final_path + '"'
@@ -212,7 +335,7 @@ class BamMethylData:
         # stdout, stderr = sort_process.communicate()
         # print(datetime.datetime.now().isoformat() + ": finished sort of file")
 
-        idx_command = f"samtools index {final_path}"
+        idx_command = f"samtools index -@ {self.sam_threads} {final_path}"
         print('starting index of output bam ' + datetime.datetime.now().isoformat())
         idx_process = subprocess.Popen(shlex.split(idx_command), stdout=subprocess.PIPE, stdin=subprocess.PIPE)
         stdout, stderr = idx_process.communicate()
@@ -230,6 +353,9 @@ def add_cpg_args(parser):
                              'suffix is "counts".')
     parser.add_argument('--add_pat', action='store_true',
                         help='Indicates whether to add the methylation pattern of the read (pair).')
+    parser.add_argument('--samtools_threads', type=int, default=0,
+                        help='Number of additional threads used by each samtools subprocess (samtools -@). '
+                             'The number of parallel chromosome jobs is reduced accordingly [0]')
     return parser
 
 
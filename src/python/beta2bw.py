@@ -4,20 +4,128 @@ import argparse
 import os.path as op
 import sys
 import subprocess
+import tempfile
+from multiprocessing import Pool, get_start_method
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
 from utils_wgbs import delete_or_skip, validate_file_list, GenomeRefPaths, \
-                       add_GR_args, IllegalArgumentError, check_executable
+                       add_GR_args, IllegalArgumentError, check_executable, \
+                       validate_single_file, load_dict, load_dict_section, \
+                       read_shell, beta2vec, add_multi_thread_args
 from genomic_region import GenomicRegion
-from beta2bed import beta_to_bed
 import os
 import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit, prange, set_num_threads    # optional. If installed, compute beta values in a single pass
+    from numba import config as numba_config
+except ModuleNotFoundError:
+    njit = None
+
+try:
+    import pyBigWig     # optional. If installed, write bigwigs directly, without bedGraphToBigWig
+except ModuleNotFoundError:
+    pyBigWig = None
 
 BG_EXT = '.bedGraph'
 BW_EXT = '.bigwig'
+COV_EXT = '.cov'
 
 def b2bw_log(*args, **kwargs):
     print('[ wt beta_2bw ]', *args, file=sys.stderr, **kwargs)
 
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def _beta_kernel(barr, min_cov, out):
+        for i in prange(barr.shape[0]):
+            t = barr[i, 1]
+            out[i] = -1.0 if t < min_cov else barr[i, 0] / t
+
+    @njit(parallel=True)
+    def _cov_kernel(barr, min_cov, out):
+        for i in prange(barr.shape[0]):
+            t = barr[i, 1]
+            out[i] = 0 if t < min_cov else t
+
+
+def set_numba_threads(nr_threads):
+    """ limit the numba kernels to nr_threads threads.
+        set_num_threads raises for more than NUMBA_NUM_THREADS threads """
+    if njit is not None:
+        set_num_threads(max(1, min(nr_threads, numba_config.NUMBA_NUM_THREADS)))
+
+
+def beta_vec(barr, min_cov):
+    """ beta values of a (meth, cov) array. -1 for sites with less than min_cov coverage """
+    if njit is None:
+        return beta2vec(barr, min_cov=min_cov, na=-1)
+    out = np.empty(barr.shape[0], dtype=np.float32)
+    _beta_kernel(barr, min_cov, out)
+    return out
+
+
+def cov_vec(barr, min_cov):
+    """ coverage of a (meth, cov) array. 0 for sites with less than min_cov coverage """
+    if njit is None:
+        return np.where(barr[:, 1] >= min_cov, barr[:, 1], 0)
+    out = np.empty(barr.shape[0], dtype=np.int32)
+    _cov_kernel(barr, min_cov, out)
+    return out
+
+
+def format_values(values, fmt):
+    """
+    Round values as printing them with fmt (e.g. '%.3g') would, so bigwigs
+    written by pyBigWig hold the same values as the bedGraphToBigWig ones.
+    Each distinct value is formatted only once.
+    """
+    uniq, inv = np.unique(values, return_inverse=True)
+    return np.array([float(fmt % v) for v in uniq])[inv.ravel()]
+
+
+def sort_by_chrom(df):
+    """
+    Sort a bed DataFrame by chr, then by start, as bedGraphToBigWig requires
+    (chromosomes in case-sensitive lexicographic order).
+    Chromosome names are compared only once each, and rows are ordered by
+    integer keys, rather than sorting the object-dtype chr column itself.
+    """
+    codes, names = pd.factorize(df['chr'])
+    rank = np.empty(len(names), dtype=int)
+    rank[np.argsort(np.asarray(names, dtype=str))] = np.arange(len(names))
+    chr_keys = rank[codes]
+    starts = df['start'].values
+    # skip the sort if the table is already sorted
+    dk = np.diff(chr_keys)
+    if np.all((dk > 0) | ((dk == 0) & (np.diff(starts) >= 0))):
+        return df
+    order = np.lexsort((starts, chr_keys))   # stable
+    return df.iloc[order].reset_index(drop=True)
+
+
+def shm_has_room(nbytes, shm_dir='/dev/shm'):
+    """ is there room for nbytes in shared memory.
+        Writing past the limit of /dev/shm raises SIGBUS, not an exception, so check it in advance """
+    try:
+        st = os.statvfs(shm_dir)
+    except OSError:     # e.g. no /dev/shm
+        return True
+    return st.f_bavail * st.f_frsize > nbytes
+
+
+def attach_shm(name):
+    try:
+        # the creating process owns (and unlinks) the block
+        return SharedMemory(name=name, track=False)
+    except TypeError:   # python < 3.13
+        shm = SharedMemory(name=name)
+        # attaching registers the block with the resource tracker, which would unlink it (again) on exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
 class BetaToBigWig:
     def __init__(self, args):
         self.args = args
@@ -26,7 +134,157 @@ class BetaToBigWig:
         self.name = ''
         if not op.isdir(self.outdir):
             raise IllegalArgumentError('Invalid output directory: ' + self.outdir)
-        self.chrom_sizes = GenomeRefPaths(args.genome).chrom_sizes
+        self.genome = GenomeRefPaths(args.genome)
+        self.chrom_sizes = self.genome.chrom_sizes
+        self.shm = {}
+        self.shm_owner = True
+        self.chrom_names, self.ref_dict = self.dict_arrays(self.load_dict())
+
+    @staticmethod
+    def dict_arrays(rf):
+        """
+        Convert the CpG dictionary to compact numpy arrays.
+        chr is stored as integer codes to the chromosome names table.
+        :return: chromosome names, dictionary of numpy arrays (chr, start, end, idx)
+        """
+        codes, names = pd.factorize(rf['chr'])
+        cols = {'chr': codes.astype(np.int16 if len(names) < 2 ** 15 else np.int32),
+                'start': rf['start'].values.astype(np.int32),
+                'end': rf['end'].values.astype(np.int32),
+                'idx': rf['idx'].values.astype(np.int32)}
+        return np.asarray(names, dtype=str), cols
+
+    def share_dict(self):
+        """
+        Move the CpG dictionary arrays to shared memory blocks, so worker
+        processes view them without copying them (see __getstate__).
+        Only needed when workers are not forked - forked workers share the
+        plain arrays (copy-on-write) anyway.
+        If there is not enough shared memory, keep the plain arrays.
+        """
+        nbytes = sum(arr.nbytes for arr in self.ref_dict.values())
+        if not shm_has_room(nbytes):
+            b2bw_log('not enough shared memory. Copying the CpG dictionary to each worker')
+            return
+        ref = {}
+        try:
+            for col, arr in self.ref_dict.items():
+                self.shm[col] = SharedMemory(create=True, size=arr.nbytes)
+                ref[col] = np.ndarray(arr.shape, dtype=arr.dtype, buffer=self.shm[col].buf)
+                ref[col][:] = arr
+        except OSError as e:
+            b2bw_log(f'failed allocating shared memory ({e}). Copying the CpG dictionary to each worker')
+            ref = None
+            self.cleanup_shm()
+            return
+        self.ref_dict = ref
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if not self.shm:
+            return state
+        # pickle only the names of the shared memory blocks, not the arrays
+        state['shm'] = {col: shm.name for col, shm in self.shm.items()}
+        state['ref_dict'] = {col: (arr.dtype.str, arr.shape) for col, arr in self.ref_dict.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not self.shm:
+            return
+        self.shm = {col: attach_shm(name) for col, name in state['shm'].items()}
+        self.ref_dict = {col: np.ndarray(shape, dtype=dtype, buffer=self.shm[col].buf)
+                         for col, (dtype, shape) in state['ref_dict'].items()}
+        self.shm_owner = False
+
+    def cleanup(self):
+        self.ref_dict = None    # release the views before closing the blocks
+        self.cleanup_shm()
+
+    def cleanup_shm(self):
+        for shm in self.shm.values():
+            shm.close()
+            if self.shm_owner:
+                if sys.version_info < (3, 13):
+                    # the workers unregistered their attachments (see attach_shm). With a shared
+                    # resource tracker, this removed the owner registration too - restore it for unlink
+                    resource_tracker.register(shm._name, 'shared_memory')
+                shm.unlink()
+        self.shm = {}
+
+    def load_dict(self):
+        """
+        Load the CpG dictionary (chr, start, end, idx) of the requested sites.
+        start and end are the bed coordinates of the CpG: [locus - 1, locus + 1)
+        """
+        if self.args.bed_file:
+            validate_single_file(self.args.bed_file)
+            # CpG [locus - 1, locus + 1) overlaps [start, end) iff start <= locus <= end (as bedtools intersect),
+            # while tabix -R matches loci start + 1 .. end. Query the bed regions extended by one base
+            with tempfile.NamedTemporaryFile('w', suffix='.bed') as ext_bed:
+                cmd = f'gzip -cdf {self.args.bed_file} | awk -v OFS="\\t" \'$1 !~ /^#/ && $2 ~ /^[0-9]+$/ ' \
+                      f'{{s = $2 - 1; if (s < 0) s = 0; print $1, s, $3}}\' > {ext_bed.name}'
+                subprocess.check_call(cmd, shell=True)
+                rf = load_dict_section(' -R ' + ext_bed.name, self.gr.genome_name)
+            rf = rf.drop_duplicates('idx')    # in case the bed regions overlap
+        elif self.gr.is_whole():
+            rf = load_dict(genome_name=self.gr.genome_name)
+        else:
+            # the rev dictionary is indexed by site index, so the sites range is exact
+            s, e = self.gr.sites
+            cmd = f'tabix {self.gr.genome.revdict_path} {self.gr.chrom}:{s}-{e - 1}'
+            rf = read_shell(cmd, names=['chr', 'start', 'idx'])
+        if rf.empty:
+            raise IllegalArgumentError('[wt beta_2bw] No CpG sites in the requested region')
+        rf['end'] = rf['start'] + 1
+        rf['start'] = rf['start'] - 1
+        return sort_by_chrom(rf[['chr', 'start', 'end', 'idx']])
+
+    def load_beta(self, beta_path):
+        # map the beta file and read only the requested sites, by their indices
+        # (ref_dict may be a small subset of the genome, and may be reordered)
+        data = np.memmap(beta_path, dtype=np.uint8, mode='r').reshape((-1, 2))
+        return np.asarray(data[self.ref_dict['idx'] - 1])
+
+    def dump_bed(self, path, mask, values, fmt):
+        """
+        Dump the masked CpG sites with their values as a bedGraph
+        :param mask: boolean array. Which sites to dump
+        :param values: numpy array, one value per site
+        :param fmt: printf format of the values column
+        """
+        rf = self.ref_dict
+        out = np.rec.fromarrays([self.chrom_names[rf['chr'][mask]],
+                                 rf['start'][mask],
+                                 rf['end'][mask],
+                                 values[mask]])
+        np.savetxt(path, out, fmt=f'%s\t%d\t%d\t{fmt}')
+
+    def dump_bigwig(self, path, mask, values, fmt):
+        """
+        Write the masked CpG sites with their values directly to a bigwig, using pyBigWig
+        :param mask: boolean array. Which sites to dump
+        :param values: numpy array, one value per site
+        :param fmt: printf format of the values. They are rounded accordingly, as in the bedGraph
+        """
+        rf = self.ref_dict
+        codes = rf['chr'][mask]
+        starts = rf['start'][mask]
+        ends = rf['end'][mask]
+        values = format_values(values[mask], fmt)
+
+        # the header chromosomes must be ordered as the entries (see sort_by_chrom)
+        cf = self.genome.get_chrom_size_table()
+        bw = pyBigWig.open(path, 'w')
+        bw.addHeader(sorted((c, int(s)) for c, s in zip(cf['chr'], cf['size'])))
+
+        # add the entries chromosome by chromosome, to keep the python lists small
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1, [codes.size]])
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            if s < e:
+                bw.addEntries([self.chrom_names[codes[s]]] * (e - s), starts[s:e].tolist(),
+                              ends=ends[s:e].tolist(), values=values[s:e].tolist())
+        bw.close()
 
     def bed_graph_to_bigwig(self, bed_graph, bigwig):
         """
@@ -41,11 +299,29 @@ class BetaToBigWig:
 
         # compress or delete the bedGraph:
         if self.args.bedGraph:
-            compress = 'pigz' if check_executable('pigz') else 'gzip'
-            subprocess.check_call([compress, '-f', bed_graph])
+            self.compress_bed_graph(bed_graph)
         else:
             os.remove(bed_graph)
 
+    def compress_bed_graph(self, bed_graph):
+        compress = 'pigz' if check_executable('pigz') else 'gzip'
+        subprocess.check_call([compress, '-f', bed_graph])
+
+    def dump(self, bed_graph, bigwig, mask, values, fmt):
+        """
+        Dump the masked CpG sites with their values to a bigwig,
+        and to a gzipped bedGraph if requested (--bedGraph)
+        """
+        if pyBigWig is None:
+            self.dump_bed(bed_graph, mask, values, fmt)
+            self.bed_graph_to_bigwig(bed_graph, bigwig)
+            return
+
+        b2bw_log(f'[{self.name}] writing bigwig...')
+        self.dump_bigwig(bigwig, mask, values, fmt)
+        if self.args.bedGraph:
+            self.dump_bed(bed_graph, mask, values, fmt)
+            self.compress_bed_graph(bed_graph)
 
     def run_beta_to_bw(self, beta_path):
         self.name = op.basename(beta_path)
@@ -58,19 +334,33 @@ class BetaToBigWig:
         if not delete_or_skip(out_bigwig, self.args.force):
             return
 
-        # convert beta to bed:
-        b2bw_log(f'[{self.name}] Dumping bed...')
-        beta_to_bed(beta_path=beta_path,
-                    gr=self.gr,
-                    bed_file=self.args.bed_file,
-                    min_cov=self.args.min_cov,
-                    mean=True,
-                    keep_na=self.args.keep_na,
-                    force=True,
-                    opath=out_bed_graph)
+        b2bw_log(f'[{self.name}] Dumping beta values...')
+        barr = self.load_beta(beta_path)
+        min_cov = max(1, self.args.min_cov)
+        beta = beta_vec(barr, min_cov)
+        covered = beta != -1
+        mask = np.ones(beta.shape, dtype=bool) if self.args.keep_na else covered
+        self.dump(out_bed_graph, out_bigwig, mask, beta, '%.3g')
+
+        # dump coverage:
+        if self.args.dump_cov:
+            b2bw_log(f'[{self.name}] Dumping coverage...')
+            cov = cov_vec(barr, min_cov)
+            self.dump(prefix + COV_EXT + BG_EXT, prefix + COV_EXT + BW_EXT, mask, cov, '%d')
 
-        # convert bedGraphs to bigWigs:
-        self.bed_graph_to_bigwig(out_bed_graph, out_bigwig)
+
+# the BetaToBigWig object of the current worker process
+_worker_b2bw = None
+
+def _init_worker(b2bw, numba_threads):
+    # set once per worker, so the CpG dictionary is not sent along with every task
+    global _worker_b2bw
+    _worker_b2bw = b2bw
+    set_numba_threads(numba_threads)
+
+
+def _run_worker(beta_path):
+    _worker_b2bw.run_beta_to_bw(beta_path)
 
 
 def parse_args():
@@ -91,6 +381,7 @@ def parse_args():
                              ' Sites with less than MIN_COV coverage are considered as missing.')
     parser.add_argument('--outdir', '-o', default='.', help='Output directory. [.]')
     add_GR_args(parser, bed_file=True)
+    add_multi_thread_args(parser)
     args = parser.parse_args()
     return args
 
@@ -98,18 +389,31 @@ def parse_args():
 def main():
     """
     Convert beta file[s] to bigwig file[s].
-    Assuming bedGraphToBigWig is installed and in PATH
+    Uses pyBigWig if installed. Otherwise, assuming bedGraphToBigWig is installed and in PATH
     """
     args = parse_args()
     validate_file_list(args.beta_paths, '.beta')
-    if not check_executable('bedGraphToBigWig', verbose=True):
+    if pyBigWig is None and not check_executable('bedGraphToBigWig', verbose=True):
         return
 
     b = BetaToBigWig(args)
-    for beta in args.beta_paths:
-        b.run_beta_to_bw(beta)
+    try:
+        nr_workers = max(1, min(args.threads, len(args.beta_paths)))
+        if nr_workers == 1:
+            set_numba_threads(args.threads)
+            for beta in args.beta_paths:
+                b.run_beta_to_bw(beta)
+            return
+
+        # beta files are independent - process them in parallel
+        numba_threads = max(1, args.threads // nr_workers)
+        if get_start_method() != 'fork':
+            b.share_dict()
+        with Pool(nr_workers, initializer=_init_worker, initargs=(b, numba_threads)) as p:
+            p.map(_run_worker, args.beta_paths, chunksize=1)
+    finally:
+        b.cleanup()
 
 
 if __name__ == '__main__':
     main()
-
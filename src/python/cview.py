@@ -3,12 +3,30 @@
 import argparse
 from utils_wgbs import MAX_PAT_LEN, pat_sampler, validate_single_file, \
     add_GR_args, cview_tool, collapse_pat_script, \
-    cview_extend_blocks_script, validate_local_exe
+    cview_extend_blocks_script, validate_local_exe, GenomeRefPaths, \
+    check_executable, IllegalArgumentError
 from genomic_region import GenomicRegion
-from beta_to_blocks import load_blocks_file
 import subprocess
+import tempfile
+import gzip
 import os.path as op
 
+# if the extended blocks cover more than this fraction of the CpG sites,
+# read the whole pat file instead of querying it with tabix
+MAX_TABIX_FRAC = 0.5
+# bed files larger than this (~1M lines) which start at chr1 are assumed to span the whole genome
+LARGE_BED_BYTES = 40 * 2 ** 20
+LARGE_GZ_BED_BYTES = 10 * 2 ** 20   # same, for gzipped bed files (1M blocks are ~13MB)
+
+PIGZ = check_executable('pigz')
+
+
+def gunzip_cmd(args):
+    """ decompress to stdout. Use pigz if available """
+    if PIGZ:
+        return f'pigz -dc -p {getattr(args, "threads", 1)}'
+    return 'gunzip -c'
+
 
 def subprocess_wrap_sigpipe(cmd):
     try:
@@ -29,7 +47,7 @@ def view_gr(pat, args, get_cmd=False):
     if gr.is_whole():
         s = 1
         e = gr.genome.get_nr_sites() + 1
-        cmd = f'gunzip -c {pat} '
+        cmd = f'{gunzip_cmd(args)} {pat} '
     else:
         s, e = gr.sites
         ms = max(1, s - MAX_PAT_LEN)
@@ -41,6 +59,8 @@ def view_gr(pat, args, get_cmd=False):
         validate_local_exe(pat_sampler)
         cmd += f' | {pat_sampler} {args.sub_sample} '
     if not gr.is_whole():
+        # keep GNU sort: in a pipe it runs concurrently with collapse_pat.pl, which beats
+        # sorting and collapsing in a single python process
         cmd += f' | sort -k2,2n -k3,3'
         if args.shuffle:
             cmd += 'R'
@@ -65,19 +85,69 @@ def set_view_flags(args):
     return view_flags
 
 
+def extend_blocks(bpath, args):
+    """ extend and merge the blocks (chr, startCpG, endCpG), to query the pat with """
+    cmd = gunzip_cmd(args) if bpath.endswith('.gz') else 'cat'
+    # skip comments and header lines
+    cmd += f' {bpath} | awk \'$1 !~ /^#/ && $2 ~ /^[0-9]+$/\' | {cview_extend_blocks_script}'
+    return subprocess.check_output(cmd, shell=True).decode()
+
+
+def peek_bed(bpath):
+    """ the fields of the first (non comment) line of a bed file """
+    with (gzip.open if bpath.endswith('.gz') else open)(bpath, 'rt') as f:
+        for line in f:
+            if not line.startswith('#'):
+                return line.rstrip('\n').split('\t')
+    return []
+
+
+def validate_blocks_file(bpath):
+    """ cheap check of the first line: chr, start, end, startCpG, endCpG """
+    if len(peek_bed(bpath)) < 5:
+        msg = f'Invalid blocks file: {bpath}. less than 5 columns.\n'
+        msg += f'Run wgbstools convert -L {bpath} -o OUTPUT_REGION_FILE to add the CpG columns'
+        raise IllegalArgumentError(msg)
+
+
+def is_large_bed(bpath):
+    """ O(1) probe: is the bed file large, and does it start at chr1 """
+    max_bytes = LARGE_GZ_BED_BYTES if bpath.endswith('.gz') else LARGE_BED_BYTES
+    if op.getsize(bpath) <= max_bytes:
+        return False
+    return peek_bed(bpath)[:1] in (['1'], ['chr1'])
+
+
 def view_bed(pat, args):
     # assume columns 4-5 of args.bed_file are startCpG, endCpG:
     bpath = args.bed_file
-
-    # validate blocks file. If it's long, and starts with "chr1", use gunzip instead of tabix.
-    df = load_blocks_file(bpath, nrows=1e6)
-    if df.shape[0] == 1e6 and df.iloc[0, 0] in ('1', 'chr1'):
-        tabix_cmd = f'gunzip -c {pat} '
-    else:
-        # extended blocks:
-        tabix_cmd = 'gunzip -c' if bpath.endswith('.gz') else 'cat'
-        tabix_cmd += f' {bpath} | {cview_extend_blocks_script} | tabix -R - {pat} '
-
+    validate_single_file(bpath)
+    validate_blocks_file(bpath)
+
+    # a large bed file starting at chr1 covers most of the genome - skip extending it
+    if is_large_bed(bpath):
+        run_view_bed(f'{gunzip_cmd(args)} {pat} ', bpath, args)
+        return
+
+    # query only the extended blocks with tabix, unless they cover most of the genome.
+    # In that case tabix would read most of the pat anyway, so use gunzip instead.
+    ext_bed = extend_blocks(bpath, args)
+    nr_covered = 0
+    for line in ext_bed.splitlines():
+        _, start, end = line.split('\t')
+        nr_covered += int(end) - int(start)
+    nr_sites = GenomeRefPaths(args.genome).get_nr_sites()
+    with tempfile.NamedTemporaryFile('w', suffix='.bed') as ext_file:
+        if nr_covered > MAX_TABIX_FRAC * nr_sites:
+            tabix_cmd = f'{gunzip_cmd(args)} {pat} '
+        else:
+            ext_file.write(ext_bed)
+            ext_file.flush()
+            tabix_cmd = f'tabix -R {ext_file.name} {pat} '
+        run_view_bed(tabix_cmd, bpath, args)
+
+
+def run_view_bed(tabix_cmd, bpath, args):
     view_flags = set_view_flags(args)
     cmd = tabix_cmd + f' | {cview_tool} {view_flags} --blocks_path {bpath}'
     if args.sub_sample is not None:  # sub-sample reads
@@ -102,7 +172,7 @@ def cview(pat, args):
 #                        #
 ##########################
 
-def add_view_flags(parser, sub_sample=True, out_path=True):
+def add_view_flags(parser, sub_sample=True, out_path=True, threads=True):
     add_GR_args(parser, bed_file=True)
     parser.add_argument('--strict', action='store_true',
                         help='pat: Truncate reads that start/end outside the given region. '
@@ -120,6 +190,10 @@ def add_view_flags(parser, sub_sample=True, out_path=True):
                             help='pat: subsample from reads. Only supported for pat')
     if out_path:
         parser.add_argument('-o', '--out_path', help='Output path. [stdout]')
+    if threads:
+        # not all CPUs by default - cview often runs as one of many concurrent processes (e.g. merge)
+        parser.add_argument('-@', '--threads', type=int, default=1,
+                            help='pat: Number of threads for decompressing with pigz [1]')
     return parser
 
 